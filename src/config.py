@@ -10,6 +10,10 @@ MINIO_ACCESS_KEY = os.getenv("MINIO_ACCESS_KEY", "minioadmin")
 MINIO_SECRET_KEY = os.getenv("MINIO_SECRET_KEY", "minioadmin")
 MINIO_BUCKET = os.getenv("MINIO_BUCKET", "weather-maps")
 
+# Skip renders whose output already exists in the bucket (protects against
+# RabbitMQ redelivery storms). Set to 0 in dev to force re-render.
+SKIP_IF_EXISTS = os.getenv("SKIP_IF_EXISTS", "1") == "1"
+
 REGIONS = {
     "israel": {"lon_min": 33.5, "lon_max": 36.5, "lat_min": 29.0, "lat_max": 33.5},
     "eastern_med": {"lon_min": 25.0, "lon_max": 40.0, "lat_min": 25.0, "lat_max": 40.0},
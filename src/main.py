@@ -1,29 +1,95 @@
+import os
+
+# Keep BLAS/OpenMP single-threaded inside each render worker; the process
+# pool already occupies every core and nested threading just thrashes
+# caches. Must be set before numpy gets imported below.
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ.setdefault("MKL_NUM_THREADS", "1")
+
 import pika
+import io
 import json
-import os
 import time
+import threading
+import multiprocessing
 import config
 import concurrent.futures
-from renderer import Renderer
+from renderer import Renderer, ensure_index, _region_geometries, _resolution_for_bounds
 from storage import Storage
 
 # Global pool for map rendering (CPU bound)
 map_renderer_pool = None
 
-def process_task(grib_path, output_path, param, bounds, model, run_date, run_hour, forecast_hour, region_name):
+# Thread pool for MinIO uploads (I/O bound), so render workers hand off
+# their PNG bytes immediately and keep the CPU hot instead of blocking on
+# the network
+upload_pool = None
+_upload_storage = None
+
+def _upload_result(message, png_bytes):
+    _upload_storage.upload_bytes(png_bytes, message["url"])
+    return message
+
+# Per-worker Renderer and Storage, created once by _worker_init so each
+# pool worker keeps a persistent matplotlib figure and reuses one Minio
+# client (pooled keep-alive connections) instead of paying a TCP handshake
+# per task
+_worker_renderer = None
+_worker_storage = None
+
+def _worker_init():
+    global _worker_renderer, _worker_storage
+    _worker_renderer = Renderer()
     try:
-        renderer = Renderer()
-        storage = Storage()
-        
-        # Render
-        renderer.generate_map(grib_path, output_path, parameter=param, region_bounds=bounds, model=model)
-        
-        # Upload to MinIO
+        _worker_storage = Storage()
+    except Exception as e:
+        print(f"Warning: failed to init worker storage: {e}")
+    # Warm the clipped-geometry cache so the first render in each worker
+    # doesn't pay the shapefile read and clip
+    for bounds in config.REGIONS.values():
+        try:
+            _region_geometries(bounds, _resolution_for_bounds(bounds))
+        except Exception as e:
+            print(f"Warning: failed to preload geometries: {e}")
+
+# Batched ack bookkeeping. Delivery tags are sequential per channel, so we
+# only ever ack the highest tag whose predecessors have all finished too --
+# that way a single basic_ack(multiple=True) frame covers a whole batch of
+# GRIBs instead of one AMQP frame per message.
+_ack_lock = threading.Lock()
+_ack_frontier = 0
+_completed_tags = set()
+
+def _ack_completed(connection, channel, delivery_tag):
+    global _ack_frontier
+    with _ack_lock:
+        _completed_tags.add(delivery_tag)
+        advanced = False
+        while _ack_frontier + 1 in _completed_tags:
+            _ack_frontier += 1
+            _completed_tags.discard(_ack_frontier)
+            advanced = True
+        if advanced:
+            tag = _ack_frontier
+            # Marshal the ack back onto the connection's ioloop thread --
+            # pika channels are not thread safe. Enqueued while still
+            # holding the lock: two threads advancing the frontier
+            # back-to-back must reach the ioloop in frontier order, or a
+            # stale lower tag lands after the higher multiple=True ack
+            # already covered it and the broker closes the channel with
+            # PRECONDITION_FAILED (unknown delivery tag).
+            connection.add_callback_threadsafe(
+                lambda: channel.basic_ack(delivery_tag=tag, multiple=True)
+            )
+
+def process_task(payload, param, bounds, model, run_date, run_hour, forecast_hour, region_name):
+    try:
+        renderer = _worker_renderer if _worker_renderer is not None else Renderer()
+
         # Key structure: {model}/{run_date}/{run_hour}/{parameter}/{forecast_hour}_{region}.png
         object_name = f"{model}/{run_date}/{run_hour}/{param}/{forecast_hour}_{region_name}.png"
-        storage.upload_file(output_path, object_name)
-        
-        return {
+
+        message = {
             "model": model,
             "run_date": run_date,
             "run_hour": run_hour,
@@ -32,11 +98,29 @@ def process_task(grib_path, output_path, param, bounds, model, run_date, run_hou
             "region": region_name,
             "url": object_name
         }
+
+        # Redelivered GRIBs would re-render identical maps; a quick HEAD on
+        # the bucket short-circuits those
+        if config.SKIP_IF_EXISTS:
+            global _worker_storage
+            if _worker_storage is None:
+                _worker_storage = Storage()
+            if _worker_storage.object_exists(object_name):
+                print(f"Skipping {object_name}: already in bucket")
+                return message, None
+
+        # Render from the preloaded arrays straight into memory; no GRIB or
+        # /tmp access in the worker. The upload happens on the orchestrator
+        # side so this worker slot frees up for the next render.
+        bio = io.BytesIO()
+        renderer.render_region(payload, bio, parameter=param, region_bounds=bounds, model=model)
+
+        return message, bio.getvalue()
     except Exception as e:
         print(f"Error processing task for {param} {region_name}: {e}")
         raise e
 
-def handle_grib_task(body):
+def handle_grib_task(body, delivery_tag, consumer_connection, consumer_channel):
     global map_renderer_pool
     try:
         data = json.loads(body)
@@ -59,70 +143,115 @@ def handle_grib_task(body):
         except:
             forecast_hour = "000"
 
-        # Warm up GRIB index sequentially to avoid race conditions in parallel processing
-        print(f"Warming up GRIB index for {grib_path}...")
-        warmup_renderer = Renderer()
-        warmup_renderer.warm_up(grib_path)
-        
+        # Build the cfgrib index once up front so the per-parameter loads
+        # below all hit the same on-disk sidecar
+        ensure_index(grib_path)
+
         # Define parameters to generate
         parameters = ["t2m", "apcp", "synoptic"]
-        
+
+        # Decode each parameter once, then fan the arrays out to the render
+        # pool; the 4 regions reuse the same decoded data. The three loads
+        # run on threads -- eccodes releases the GIL during decode, so they
+        # overlap I/O and index reads and the wall clock drops to roughly
+        # the slowest load instead of their sum. ensure_index above already
+        # built the shared index, so there is no build race left.
+        loader = Renderer()
+
+        def load(param):
+            try:
+                return loader.load_parameter(grib_path, param, model=model)
+            except Exception as e:
+                print(f"Failed to load {param} from {grib_path}: {e}")
+                return None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(parameters)) as load_pool:
+            payloads = dict(zip(parameters, load_pool.map(load, parameters)))
+
         futures = []
         for param in parameters:
+            payload = payloads[param]
+            if payload is None:
+                # Load failed; don't render (and upload) error placeholders
+                # under the real object names -- leave the keys absent so a
+                # redelivery or the next cycle can fill them in
+                print(f"Skipping renders for {param}: no decoded data")
+                continue
+
             for region_name, bounds in config.REGIONS.items():
-                # Generate local output path
-                output_filename = f"{param}_{forecast_hour}_{region_name}.png"
-                output_path = os.path.join("/tmp", output_filename)
-                
                 # Submit task to global process pool
                 futures.append(map_renderer_pool.submit(
                     process_task,
-                    grib_path, output_path, param, bounds,
+                    payload, param, bounds,
                     model, run_date, run_hour, forecast_hour, region_name
                 ))
         
-        # Establish a connection for publishing results
-        try:
-            connection = pika.BlockingConnection(
-                pika.ConnectionParameters(
-                    host=config.RABBITMQ_HOST, 
-                    port=config.RABBITMQ_PORT,
-                    heartbeat=600
+        # Publish results over the consumer connection instead of opening a
+        # fresh TCP+AMQP handshake per GRIB. Publishes are marshalled onto
+        # the connection's ioloop thread since pika channels are not
+        # thread safe. The consumer already declared the exchange.
+        def publish(message):
+            consumer_connection.add_callback_threadsafe(
+                lambda: consumer_channel.basic_publish(
+                    exchange='weather_events',
+                    routing_key='map.generated',
+                    body=json.dumps(message)
                 )
             )
-            channel = connection.channel()
-            channel.exchange_declare(exchange='weather_events', exchange_type='topic', durable=True)
-            
-            # Process results as they complete
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    message = future.result()
-                    
-                    # Notify completion
-                    channel.basic_publish(
-                        exchange='weather_events',
-                        routing_key='map.generated',
-                        body=json.dumps(message)
-                    )
-                    print(f"Published map.generated: {message}")
-                except Exception as e:
-                    print(f"Task failed: {e}")
-            
-            connection.close()
-        except Exception as e:
-            print(f"Error publishing results: {e}")
+
+        # Hand finished renders to the upload pool as they complete, so
+        # uploads overlap with the remaining renders
+        upload_futures = []
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                message, png_bytes = future.result()
+                if png_bytes is None:
+                    # Map already existed; announce it without re-uploading
+                    publish(message)
+                    print(f"Published map.generated (already existed): {message}")
+                    continue
+                upload_futures.append(upload_pool.submit(_upload_result, message, png_bytes))
+            except Exception as e:
+                print(f"Task failed: {e}")
+
+        # Notify completion once each upload lands
+        for future in concurrent.futures.as_completed(upload_futures):
+            try:
+                message = future.result()
+                publish(message)
+                print(f"Published map.generated: {message}")
+            except Exception as e:
+                print(f"Upload failed: {e}")
 
     except Exception as e:
         print(f"Error in handle_grib_task: {e}")
+    finally:
+        # Ack once per GRIB after all 24 renders resolved, not per publish.
+        _ack_completed(consumer_connection, consumer_channel, delivery_tag)
 
 def main():
     print("Starting MapRenderer Service...")
     
     # Initialize global process pool
     global map_renderer_pool
-    # Use a reasonable number of workers (e.g., CPU count)
-    map_renderer_pool = concurrent.futures.ProcessPoolExecutor()
-    
+    # fork so workers inherit the already-imported matplotlib/cartopy stack
+    # instead of re-importing it (~1-2s per spawn), and size the pool to
+    # physical cores -- render tasks are CPU bound and oversubscribing
+    # logical threads just thrashes caches.
+    ctx = multiprocessing.get_context('fork')
+    workers = max(1, len(os.sched_getaffinity(0)) // 2)
+    map_renderer_pool = concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, mp_context=ctx, initializer=_worker_init
+    )
+
+    # The executor forks workers lazily on first submit, which would
+    # happen on an orchestrator thread while the pika ioloop is live --
+    # forking a multithreaded process can deadlock children on inherited
+    # locks. Force all workers to fork now, while this process is still
+    # single-threaded.
+    for future in [map_renderer_pool.submit(os.getpid) for _ in range(workers)]:
+        future.result()
+
     # Thread pool for handling incoming GRIB messages concurrently
     grib_orchestrator_pool = concurrent.futures.ThreadPoolExecutor(max_workers=5)
     
@@ -146,48 +275,79 @@ def main():
             time.sleep(5)
 
     channel = connection.channel()
-    
+
+    # Bound in-flight messages to what the render pool can actually drain.
+    # Without this, pika's default prefetch lets the broker push every queued
+    # GRIB at once, blowing memory and tripping broker-side send timeouts
+    # during a long 24-map render cycle.
+    channel.basic_qos(prefetch_count=max(2, os.cpu_count()))
+
     # Declare exchange
     channel.exchange_declare(exchange='weather_events', exchange_type='topic', durable=True)
     
-    # Determine which model to listen to
-    listen_model = os.getenv("LISTEN_MODEL", "all")
-    
-    # Use a unique queue name based on the model to avoid conflicts
-    queue_name = f'map_renderer_queue_{listen_model}'
-    channel.queue_declare(queue=queue_name, durable=True)
-    
-    if listen_model == "all":
-        channel.queue_bind(exchange='weather_events', queue=queue_name, routing_key='grib.downloaded.#')
+    # One queue per model so a slow GFS cycle can't head-of-line block
+    # ECMWF renders behind the prefetch window. Each deployment sets
+    # LISTEN_MODEL to its model; when unset, this instance consumes every
+    # model queue.
+    listen_model = os.getenv("LISTEN_MODEL")
+    if listen_model and listen_model != "all":
+        models = [listen_model]
     else:
-        channel.queue_bind(exchange='weather_events', queue=queue_name, routing_key=f'grib.downloaded.{listen_model}')
-        
-    channel.queue_bind(exchange='weather_events', queue=queue_name, routing_key='map.deleted')
+        models = ["gfs", "ecmwf"]
+
+    model_queues = []
+    for m in models:
+        queue_name = f'map_renderer_{m}'
+        channel.queue_declare(queue=queue_name, durable=True)
+        channel.queue_bind(exchange='weather_events', queue=queue_name, routing_key=f'grib.downloaded.{m}')
+        model_queues.append(queue_name)
+
+    # Deletes are cheap and idempotent, so they share one queue per
+    # deployment rather than fanning into the model queues
+    delete_queue = f"map_renderer_deletes_{'_'.join(models)}"
+    channel.queue_declare(queue=delete_queue, durable=True)
+    channel.queue_bind(exchange='weather_events', queue=delete_queue, routing_key='map.deleted')
     
     storage = Storage()
-    
-    print(f"Listening for events on queue {queue_name} (model: {listen_model})...")
+
+    # Uploads run on threads in this process, sharing one Storage client
+    global upload_pool, _upload_storage
+    upload_pool = concurrent.futures.ThreadPoolExecutor(max_workers=16)
+    _upload_storage = storage
+
+    print(f"Listening for events on queues {model_queues + [delete_queue]}...")
     
     def callback(ch, method, properties, body):
-        try:
-            if method.routing_key.startswith('grib.downloaded'):
-                # Submit to thread pool for concurrent processing
-                grib_orchestrator_pool.submit(handle_grib_task, body)
-                
-            elif method.routing_key == 'map.deleted':
-                data = json.loads(body)
-                print(f"Received delete request: {data}")
-                object_name = data.get('url')
-                if object_name:
-                    storage.delete_file(object_name)
-            
-            # Auto ack is enabled, so no manual ack needed
-        
-        except Exception as e:
-            print(f"Error processing message: {e}")
+        # Every tag must reach _ack_completed eventually -- the contiguous
+        # frontier means one dropped tag blocks acks for all later
+        # messages on the channel.
+        if method.routing_key.startswith('grib.downloaded'):
+            # handle_grib_task acks its own tag in a finally; only ack
+            # here if the hand-off itself fails.
+            try:
+                grib_orchestrator_pool.submit(
+                    handle_grib_task, body, method.delivery_tag, connection, channel
+                )
+            except Exception as e:
+                print(f"Error submitting GRIB task: {e}")
+                _ack_completed(connection, channel, method.delivery_tag)
+        else:
+            try:
+                if method.routing_key == 'map.deleted':
+                    data = json.loads(body)
+                    print(f"Received delete request: {data}")
+                    object_name = data.get('url')
+                    if object_name:
+                        storage.delete_file(object_name)
+            except Exception as e:
+                print(f"Error processing message: {e}")
+            finally:
+                _ack_completed(connection, channel, method.delivery_tag)
 
-    # Enable auto_ack to allow fire-and-forget processing
-    channel.basic_consume(queue=queue_name, on_message_callback=callback, auto_ack=True)
+    # Manual ack so the prefetch limit above is actually enforced
+    # (auto_ack makes prefetch a no-op).
+    for queue_name in model_queues + [delete_queue]:
+        channel.basic_consume(queue=queue_name, on_message_callback=callback, auto_ack=False)
     channel.start_consuming()
 
 if __name__ == "__main__":
@@ -1,3 +1,10 @@
+import os
+
+import cartopy
+# Mirror renderer.py: bake the shapefiles into the same directory the
+# service reads from at runtime
+if os.environ.get("CARTOPY_DATA_DIR"):
+    cartopy.config['data_dir'] = os.environ["CARTOPY_DATA_DIR"]
 import cartopy.io.shapereader as shpreader
 
 def download_maps():
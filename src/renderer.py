@@ -1,179 +1,648 @@
 import xarray as xr
+import matplotlib
+# Headless renders only: pin Agg before pyplot import so the first figure
+# doesn't probe for Tk/Qt GUI backends
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+from matplotlib.colors import BoundaryNorm, ListedColormap, Normalize
+
+# Simplify long paths before rasterization; the dense synoptic contour
+# lines are thousands of segments that collapse to far fewer on screen
+matplotlib.rcParams['path.simplify'] = True
+matplotlib.rcParams['path.simplify_threshold'] = 1.0
+matplotlib.rcParams['agg.path.chunksize'] = 10000
+import os
+
+import cartopy
+# Pin the Natural Earth cache to a known local path (populated at image
+# build time by preload_maps.py) so first use never downloads and the
+# per-render stat calls hit local disk rather than whatever volume
+# happens to back the home directory
+if os.environ.get("CARTOPY_DATA_DIR"):
+    cartopy.config['data_dir'] = os.environ["CARTOPY_DATA_DIR"]
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
-from cartopy.util import add_cyclic_point
-import os
+import cartopy.io.shapereader as shpreader
+from shapely.geometry import box
+import concurrent.futures
+import functools
+import hashlib
+import tempfile
+import threading
+import time
 import numpy as np
 
+# Where cfgrib index sidecars live. A deterministic per-GRIB path means
+# every open of the same file (across parameters and handler threads)
+# shares one known-good index instead of racing to write .idx files next
+# to the GRIB -- which also silently degrades to slow in-memory indexing
+# when the GRIB volume is read-only. Defaults under the temp dir so the
+# path is writable everywhere.
+_INDEX_DIR = os.environ.get("CFGRIB_INDEX_DIR") or os.path.join(tempfile.gettempdir(), "cfgrib-index")
+
+# Every GRIB leaves an .idx plus NetCDF sidecars keyed by a path digest
+# that is unique per cycle and forecast hour, so without eviction the
+# cache dir grows forever on a long-running container. Sidecars are only
+# useful within their model cycle, so anything older than two cycles is
+# dead weight. Pruning is rate-limited so concurrent loads don't all
+# rescan the directory.
+_CACHE_MAX_AGE = int(os.environ.get("GRIB_CACHE_MAX_AGE", 12 * 3600))
+_PRUNE_INTERVAL = 300
+_prune_lock = threading.Lock()
+_last_prune = 0.0
+
+def _prune_cache_dir():
+    global _last_prune
+    now = time.time()
+    with _prune_lock:
+        if now - _last_prune < _PRUNE_INTERVAL:
+            return
+        _last_prune = now
+    cutoff = now - _CACHE_MAX_AGE
+    try:
+        for name in os.listdir(_INDEX_DIR):
+            path = os.path.join(_INDEX_DIR, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    print(f"Pruned stale cache file {path}")
+            except OSError:
+                # Raced with another worker pruning the same file
+                pass
+    except OSError as e:
+        print(f"Warning: failed to prune cache dir {_INDEX_DIR}: {e}")
+
+def _idx_path(grib_path):
+    try:
+        os.makedirs(_INDEX_DIR, exist_ok=True)
+    except OSError as e:
+        print(f"Warning: cannot create index dir {_INDEX_DIR}: {e}")
+    digest = hashlib.sha1(grib_path.encode()).hexdigest()
+    return os.path.join(_INDEX_DIR, digest + ".idx")
+
+def ensure_index(grib_path):
+    """
+    Builds the cfgrib index for a GRIB file once, before any parallel use.
+    Reuses an existing sidecar if it is newer than the GRIB itself.
+    """
+    try:
+        idx = _idx_path(grib_path)
+        if os.path.exists(idx) and os.path.getmtime(idx) >= os.path.getmtime(grib_path):
+            print(f"Reusing GRIB index {idx}")
+            return idx
+        print(f"Building GRIB index for {grib_path}...")
+        xr.open_dataset(
+            grib_path, engine='cfgrib',
+            backend_kwargs={'filter_by_keys': {'shortName': '2t'}, 'indexpath': idx}
+        ).close()
+        _prune_cache_dir()
+        return idx
+    except Exception as e:
+        print(f"Warning: failed to build GRIB index for {grib_path}: {e}")
+        return None
+
+# In-memory payloads for the newest few (grib_path, parameter, mtime)
+# combinations. A redelivered message for a file this process just handled
+# then skips even the NetCDF sidecar read. Bounded to roughly two GRIBs'
+# worth of parameters so memory stays flat.
+_payload_cache = {}
+_payload_cache_lock = threading.Lock()
+_PAYLOAD_CACHE_MAX = 6
+
+def _decoded_cache_path(grib_path, parameter):
+    digest = hashlib.sha1(grib_path.encode()).hexdigest()
+    return os.path.join(_INDEX_DIR, f"{digest}.{parameter}.nc")
+
+def _load_decoded_cache(cache_path, grib_path):
+    """
+    Returns the payload stored by _save_decoded_cache, or None when the
+    sidecar is missing or older than the GRIB. Repeat loads (redeliveries,
+    service restarts mid-cycle) then skip eccodes entirely.
+    """
+    try:
+        if not os.path.exists(cache_path):
+            return None
+        if os.path.getmtime(cache_path) < os.path.getmtime(grib_path):
+            return None
+        ds = xr.open_dataset(cache_path, engine='scipy')
+        payload = {name: ds[name].values for name in ds.data_vars}
+        payload['lons'] = ds['lon'].values
+        payload['lats'] = ds['lat'].values
+        ds.close()
+        print(f"Loaded decoded cache {cache_path}")
+        return payload
+    except Exception as e:
+        print(f"Warning: failed to read decoded cache {cache_path}: {e}")
+        return None
+
+def _save_decoded_cache(cache_path, payload):
+    try:
+        data_vars = {}
+        for name, values in payload.items():
+            if name in ('lons', 'lats'):
+                continue
+            arr = np.asarray(values)
+            dims = ('lat', 'lon') if arr.ndim == 2 else ('levels',)
+            data_vars[name] = (dims, arr)
+        ds = xr.Dataset(data_vars, coords={'lat': payload['lats'], 'lon': payload['lons']})
+        # scipy writes NetCDF3, which is all these flat arrays need and
+        # avoids pulling in a zarr/netCDF4 dependency
+        tmp_path = cache_path + '.tmp'
+        ds.to_netcdf(tmp_path, engine='scipy')
+        os.replace(tmp_path, cache_path)
+        print(f"Saved decoded cache {cache_path}")
+        _prune_cache_dir()
+    except Exception as e:
+        print(f"Warning: failed to write decoded cache {cache_path}: {e}")
+
+@functools.lru_cache(maxsize=32)
+def _open_cached(grib_path, filter_key_tuple):
+    """
+    Opens a GRIB through cfgrib with the shared on-disk index, cached per
+    (path, filter). Dataset creation re-reads the full grid geometry every
+    time, so repeated loads of the same file (redeliveries, multiple
+    Renderer instances) should hit this cache rather than cfgrib.
+    """
+    return xr.open_dataset(
+        grib_path, engine='cfgrib',
+        backend_kwargs={'filter_by_keys': dict(filter_key_tuple), 'indexpath': _idx_path(grib_path)}
+    )
+
+# Clipped Natural Earth geometries cached per (region bounds, resolution).
+# add_feature(cfeature.COASTLINE) re-reads and re-projects the full global
+# shapefile on every render; clipping once per region and reusing the
+# geometries amortizes the shapely intersection work across all renders
+# in this process.
+_geometry_cache = {}
+
+def _lon_order(lons):
+    """
+    Returns (normalized ascending lons, reorder index or None) for a
+    longitude vector, converting the 0-360 GFS convention to -180..180.
+    Every configured region then falls inside one contiguous slice --
+    europe spans Greenwich, which on a 0-360 grid forced keeping the whole
+    global array -- and the grid seam moves to the antimeridian, where
+    none of our maps look, so no cyclic-point extension is needed either.
+    Computed once per load and shared by all fields on the same grid.
+    """
+    lons = np.asarray(lons)
+    if lons.max() <= 180.0:
+        return lons, None
+    wrapped = (lons + 180.0) % 360.0 - 180.0
+    order = np.argsort(wrapped)
+    return wrapped[order], order
+
+def _reorder(data, order):
+    data = np.asarray(data)
+    return data if order is None else data[..., order]
+
+def _normalize_lons(data, lons):
+    new_lons, order = _lon_order(lons)
+    return _reorder(data, order), new_lons
+
+def _crop_to_bounds(lons, lats, region_bounds, pad=1.0):
+    """
+    Returns (lat_slice, lon_slice) index slices covering the region bbox
+    plus padding. Without this, matplotlib transforms and tessellates every
+    grid point of the global field (~1M for GFS 0.25) even when the map
+    only shows the ~200-point Israel bbox. Longitudes are normalized to
+    -180..180 at load time, so every configured region fits one contiguous
+    slice; anything that still doesn't falls back to the full arrays.
+    """
+    full = (slice(None), slice(None))
+    if region_bounds is None:
+        return full
+
+    lon_min = region_bounds['lon_min'] - pad
+    lon_max = region_bounds['lon_max'] + pad
+    lat_min = region_bounds['lat_min'] - pad
+    lat_max = region_bounds['lat_max'] + pad
+
+    if lon_min < lons[0] or lon_max > lons[-1]:
+        return full
+
+    i0 = np.searchsorted(lons, lon_min, side='left')
+    i1 = np.searchsorted(lons, lon_max, side='right')
+    lon_slice = slice(max(i0 - 1, 0), i1 + 1)
+
+    if lats[0] > lats[-1]:
+        # GFS latitudes descend
+        j0 = lats.size - np.searchsorted(lats[::-1], lat_max, side='right')
+        j1 = lats.size - np.searchsorted(lats[::-1], lat_min, side='left')
+    else:
+        j0 = np.searchsorted(lats, lat_min, side='left')
+        j1 = np.searchsorted(lats, lat_max, side='right')
+    lat_slice = slice(max(j0 - 1, 0), j1 + 1)
+
+    return lat_slice, lon_slice
+
+def _display_stride(n_cols, image_width_px):
+    """
+    Stride that keeps roughly two grid columns per output pixel (Nyquist).
+    Plotting denser than the image can show -- e.g. the 0.1 deg ECMWF grid
+    on a 1200 px wide map -- just produces sub-pixel geometry that
+    matplotlib has to trace and simplify away.
+    """
+    target = image_width_px * 2
+    if n_cols <= target:
+        return 1
+    return max(1, int(n_cols // target))
+
+def _resolution_for_bounds(region_bounds):
+    """
+    Picks the cheapest Natural Earth resolution that still looks right for
+    the region size. Wide views like europe are visually identical at 110m
+    but 10-100x cheaper in geometry count than 10m.
+    """
+    if region_bounds is None:
+        return '110m'
+    area = (region_bounds['lon_max'] - region_bounds['lon_min']) * \
+           (region_bounds['lat_max'] - region_bounds['lat_min'])
+    if area <= 300:       # israel, eastern_med
+        return '10m'
+    elif area <= 1500:    # middle_east
+        return '50m'
+    return '110m'         # europe and wider
+
+def _region_geometries(region_bounds, resolution='10m'):
+    key = (tuple(sorted(region_bounds.items())) if region_bounds else None, resolution)
+    if key in _geometry_cache:
+        return _geometry_cache[key]
+
+    clip = None
+    if region_bounds:
+        # Small pad so lines don't visibly stop at the map edge
+        clip = box(
+            region_bounds['lon_min'] - 1, region_bounds['lat_min'] - 1,
+            region_bounds['lon_max'] + 1, region_bounds['lat_max'] + 1
+        )
+
+    coastline = []
+    borders = []
+    for category, name, out in (
+        ('physical', 'coastline', coastline),
+        ('cultural', 'admin_0_boundary_lines_land', borders),
+    ):
+        path = shpreader.natural_earth(resolution=resolution, category=category, name=name)
+        for geom in shpreader.Reader(path).geometries():
+            if clip is None:
+                out.append(geom)
+                continue
+            clipped = clip.intersection(geom)
+            if not clipped.is_empty:
+                out.append(clipped)
+
+    _geometry_cache[key] = (coastline, borders)
+    return coastline, borders
+
+# Styled features built from the clipped geometries, cached alongside them.
+# Reusing the same Feature (and thus the same shapely objects) across
+# renders lets cartopy's internal projected-geometry cache hit instead of
+# re-projecting the lines for every new artist.
+_feature_cache = {}
+
+def _region_features(region_bounds, resolution):
+    key = (tuple(sorted(region_bounds.items())) if region_bounds else None, resolution)
+    if key not in _feature_cache:
+        coastline, borders = _region_geometries(region_bounds, resolution)
+        _feature_cache[key] = (
+            cfeature.ShapelyFeature(coastline, ccrs.PlateCarree(),
+                                    edgecolor='black', facecolor='none', linewidth=1.5),
+            cfeature.ShapelyFeature(borders, ccrs.PlateCarree(),
+                                    edgecolor='black', facecolor='none', linestyle=':', linewidth=1),
+        )
+    return _feature_cache[key]
+
 class Renderer:
     def __init__(self):
-        pass
+        # Figure/axes cached per projection (see _get_axes)
+        self._axes_cache = {}
 
-    def warm_up(self, grib_path):
+    def _open_grib(self, grib_path, filter_by_keys):
+        return _open_cached(grib_path, tuple(sorted(filter_by_keys.items())))
+
+    def _get_axes(self, projection, projection_key):
         """
-        Opens the GRIB file with various filters to ensure index files are created
-        sequentially before parallel processing.
+        Returns a (fig, ax) pair cached per projection. Building a fresh
+        figure and GeoAxes (backend init, projection setup, font cache
+        lookup) 24 times per GRIB is pure overhead, and a worker
+        round-robins across the four region projections, so a single
+        cached slot would still rebuild on nearly every render. One small
+        figure per projection keeps every region's axes warm.
         """
-        print(f"Warming up GRIB index for {grib_path}...")
-        try:
-            # t2m
-            xr.open_dataset(grib_path, engine='cfgrib', backend_kwargs={'filter_by_keys': {'shortName': '2t'}}).close()
-            # apcp
-            xr.open_dataset(grib_path, engine='cfgrib', backend_kwargs={'filter_by_keys': {'shortName': 'tp'}}).close()
-            # synoptic - gh
-            xr.open_dataset(grib_path, engine='cfgrib', backend_kwargs={'filter_by_keys': {'typeOfLevel': 'isobaricInhPa', 'level': 500, 'shortName': 'gh'}}).close()
-            # synoptic - t
-            xr.open_dataset(grib_path, engine='cfgrib', backend_kwargs={'filter_by_keys': {'typeOfLevel': 'isobaricInhPa', 'level': 500, 'shortName': 't'}}).close()
-            # synoptic - prmsl
-            xr.open_dataset(grib_path, engine='cfgrib', backend_kwargs={'filter_by_keys': {'typeOfLevel': 'meanSea', 'shortName': 'prmsl'}}).close()
-            print("GRIB index warm-up complete.")
-        except Exception as e:
-            print(f"Warning: Failed to warm up GRIB index: {e}")
+        cached = self._axes_cache.get(projection_key)
+        if cached is not None:
+            fig, ax = cached
+            ax.clear()
+            return fig, ax
+        fig = plt.figure(figsize=(12, 9))
+        ax = fig.add_subplot(1, 1, 1, projection=projection)
+        self._axes_cache[projection_key] = (fig, ax)
+        return fig, ax
 
-    def generate_map(self, grib_path, output_path, parameter="t2m", region_bounds=None, model="gfs"):
+    def _reset_figure(self):
+        for fig, _ in self._axes_cache.values():
+            plt.close(fig)
+        self._axes_cache = {}
+
+    def load_parameter(self, grib_path, parameter, model="gfs"):
         """
-        Generates a map from a GRIB file.
-        
+        Opens the GRIB file once for a parameter and returns the decoded
+        arrays as a payload dict. The payload is shared across all regions,
+        so the cfgrib index build and GRIB message decode are paid once per
+        parameter instead of once per (parameter x region).
+
         Args:
             grib_path: Path to the input GRIB2 file.
-            output_path: Path where the generated PNG should be saved.
+            parameter: The parameter to load ('t2m', 'apcp' or 'synoptic').
+            model: The model name ('gfs' or 'ecmwf').
+        """
+        try:
+            mem_key = (grib_path, parameter, os.path.getmtime(grib_path))
+        except OSError:
+            mem_key = (grib_path, parameter, None)
+        with _payload_cache_lock:
+            if mem_key in _payload_cache:
+                return _payload_cache[mem_key]
+
+        cache_path = _decoded_cache_path(grib_path, parameter)
+        payload = _load_decoded_cache(cache_path, grib_path)
+
+        if payload is None:
+            print(f"Loading {parameter} from {grib_path} (model: {model})...")
+            payload = self._decode_parameter(grib_path, parameter, model)
+            _save_decoded_cache(cache_path, payload)
+
+        with _payload_cache_lock:
+            _payload_cache[mem_key] = payload
+            while len(_payload_cache) > _PAYLOAD_CACHE_MAX:
+                _payload_cache.pop(next(iter(_payload_cache)))
+
+        return payload
+
+    def _decode_parameter(self, grib_path, parameter, model):
+        if parameter == "t2m":
+            ds = self._open_grib(grib_path, {'shortName': '2t'})
+
+            # Kelvin to Celsius in place on the float32 copy -- the xarray
+            # arithmetic allocated a float64 intermediate of the full grid
+            data = ds['t2m'].values.astype(np.float32)
+            np.subtract(data, np.float32(273.15), out=data)
+
+            # Normalize longitudes once here; every region reuses the
+            # rolled array. float32 is plenty for plotting and halves
+            # memory traffic on every pass downstream.
+            data_c, lons_c = _normalize_lons(data, ds['t2m'].longitude.values)
+
+            # Precompute the auto levels once; contourf would otherwise
+            # redo the global min/max scan and linspace for every region.
+            levels = np.linspace(float(data_c.min()), float(data_c.max()), 101, dtype=np.float32)
+
+            return {
+                'data': data_c,
+                'lons': lons_c,
+                'lats': ds['t2m'].latitude.values,
+                'levels': levels
+            }
+        elif parameter == "apcp":
+            ds = self._open_grib(grib_path, {'shortName': 'tp'})
+            tp = ds['tp']
+            data = tp.values.astype(np.float32)
+
+            # Convert units if necessary
+            if model == 'ecmwf':
+                # ECMWF tp is in meters, convert to mm (kg/m^2) in place
+                np.multiply(data, np.float32(1000.0), out=data)
+
+            data_c, lons_c = _normalize_lons(data, tp.longitude.values)
+
+            return {
+                'data': data_c,
+                'lons': lons_c,
+                'lats': tp.latitude.values
+            }
+        elif parameter == "synoptic":
+            # Both 500 hPa fields (gh and t) live in one hypercube, so a
+            # single filtered open fetches them together. The level-500 and
+            # mean-sea opens decode independently and eccodes releases the
+            # GIL, so a pair of threads overlaps them.
+            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+                f_500 = pool.submit(self._open_grib, grib_path, {'typeOfLevel': 'isobaricInhPa', 'level': 500})
+                f_msl = pool.submit(self._open_grib, grib_path, {'typeOfLevel': 'meanSea'})
+                ds_500 = f_500.result()
+                ds_msl = f_msl.result()
+            hgt = ds_500['gh']
+
+            # Unit conversions run in place on the float32 copies (see t2m)
+            tmp_vals = ds_500['t'].values.astype(np.float32)
+            np.subtract(tmp_vals, np.float32(273.15), out=tmp_vals) # Kelvin -> Celsius
+
+            # MSLP
+            prmsl_vals = (ds_msl['msl'] if model == 'ecmwf' else ds_msl['prmsl']).values.astype(np.float32)
+            np.divide(prmsl_vals, np.float32(100.0), out=prmsl_vals) # Pa -> hPa
+
+            # One longitude sort shared by all three fields; each previous
+            # call redid the wrap + argsort on the same coordinate vector
+            lons_c, order = _lon_order(hgt.longitude.values)
+            hgt_c = _reorder(hgt.values.astype(np.float32), order)
+            tmp_c = _reorder(tmp_vals, order)
+            prmsl_c = _reorder(prmsl_vals, order)
+
+            return {
+                'hgt': hgt_c,
+                'tmp': tmp_c,
+                'prmsl': prmsl_c,
+                'lons': lons_c,
+                'lats': hgt.latitude.values
+            }
+        else:
+            raise ValueError(f"Unknown parameter: {parameter}")
+
+    def render_region(self, payload, out, parameter="t2m", region_bounds=None, model="gfs"):
+        """
+        Renders one region from a preloaded parameter payload. Regions are
+        pure extent changes on the same data, so no GRIB access happens here.
+
+        Args:
+            payload: Arrays returned by load_parameter.
+            out: File-like object the PNG is written to (e.g. io.BytesIO).
             parameter: The parameter to plot (e.g., 't2m' for 2m temperature).
             region_bounds: Dictionary with lon_min, lon_max, lat_min, lat_max.
             model: The model name ('gfs' or 'ecmwf').
         """
-        print(f"Generating map for {parameter} from {grib_path} (model: {model})...")
-        
+        print(f"Rendering {parameter} map for region {region_bounds} (model: {model})...")
+
         try:
             # Determine projection
             if region_bounds:
                 central_lon = (region_bounds['lon_min'] + region_bounds['lon_max']) / 2
                 central_lat = (region_bounds['lat_min'] + region_bounds['lat_max']) / 2
                 projection = ccrs.LambertConformal(central_longitude=central_lon, central_latitude=central_lat)
+                projection_key = ('lcc', central_lon, central_lat)
             else:
                 projection = ccrs.PlateCarree()
+                projection_key = ('platecarree',)
+
+            # Plotting. 12x9 inches at dpi=100 gives web-sized output;
+            # the old 24x18 at dpi=300 produced 7200x5400 px PNGs that
+            # dominated render CPU and upload size.
+            fig, ax = self._get_axes(projection, projection_key)
+
+            # A colorbar built from a bare ScalarMappable cannot give its
+            # stolen space back: Colorbar.remove() restores the parent
+            # geometry through mappable.axes, which a bare mappable lacks,
+            # so the cached axes would shrink a little more on every
+            # render. Snapshot the geometry here and restore it below.
+            ax_position = ax.get_position()
 
-            # Plotting
-            plt.figure(figsize=(24, 18))
-            ax = plt.axes(projection=projection)
-            
             if region_bounds:
                 ax.set_extent([
                     region_bounds['lon_min'], region_bounds['lon_max'],
                     region_bounds['lat_min'], region_bounds['lat_max']
                 ], crs=ccrs.PlateCarree())
-            
-            # Add map features
-            ax.add_feature(cfeature.COASTLINE, linewidth=1.5)
-            ax.add_feature(cfeature.BORDERS, linestyle=':', linewidth=1)
-            
+
+            # Add map features (clipped to the region and cached per worker)
+            coastline_feature, borders_feature = _region_features(region_bounds, _resolution_for_bounds(region_bounds))
+            ax.add_feature(coastline_feature)
+            ax.add_feature(borders_feature)
+
+            lons = payload['lons']
+            lats = payload['lats']
+
+            # Only hand matplotlib the data that can actually appear on the
+            # map; set_extent alone still transforms every grid point
+            lat_sl, lon_sl = _crop_to_bounds(lons, lats, region_bounds)
+            sub_lons = lons[lon_sl]
+            sub_lats = lats[lat_sl]
+
+            # And no denser than the output image can actually show
+            stride = _display_stride(sub_lons.size, fig.get_size_inches()[0] * 100)
+            if stride > 1:
+                lat_sl = slice(lat_sl.start, lat_sl.stop, stride)
+                lon_sl = slice(lon_sl.start, lon_sl.stop, stride)
+                sub_lons = lons[lon_sl]
+                sub_lats = lats[lat_sl]
+
             if parameter == "t2m":
-                ds = xr.open_dataset(grib_path, engine='cfgrib', backend_kwargs={'filter_by_keys': {'shortName': '2t'}})
-                # Convert Kelvin to Celsius
-                temp_c = ds['t2m'] - 273.15
-                
-                # Add cyclic point to avoid white line at Greenwich
-                data = temp_c.values
-                lons = temp_c.longitude.values
-                lats = temp_c.latitude.values
-                data_c, lons_c = add_cyclic_point(data, coord=lons)
-                
-                im = ax.contourf(lons_c, lats, data_c, transform=ccrs.PlateCarree(), cmap='coolwarm', levels=100)
-                plt.colorbar(im, ax=ax, label='Temperature (°C)')
-                plt.title("2m Temperature (°C)")
+                # The grid is regular lat/lon, so the field can go straight
+                # to Agg's image resampler: one blit instead of building a
+                # quad mesh or contour polygons
+                origin = 'upper' if sub_lats[0] > sub_lats[-1] else 'lower'
+                im = ax.imshow(
+                    payload['data'][lat_sl, lon_sl],
+                    extent=[sub_lons[0], sub_lons[-1], sub_lats.min(), sub_lats.max()],
+                    transform=ccrs.PlateCarree(), origin=origin,
+                    cmap='coolwarm',
+                    vmin=payload['levels'][0], vmax=payload['levels'][-1],
+                    interpolation='bilinear'
+                )
+                # Build the colorbar from a bare ScalarMappable instead of
+                # the image artist; colorbar(im) introspects the artist and
+                # recomputes the layout, while the mappable path just draws
+                # the precomputed gradient
+                sm = plt.cm.ScalarMappable(
+                    norm=Normalize(vmin=payload['levels'][0], vmax=payload['levels'][-1]),
+                    cmap='coolwarm')
+                cbar = fig.colorbar(sm, ax=ax, label='Temperature (°C)')
+                ax.set_title("2m Temperature (°C)")
             elif parameter == "apcp":
-                ds = xr.open_dataset(grib_path, engine='cfgrib', backend_kwargs={'filter_by_keys': {'shortName': 'tp'}})
                 # Use specific levels to make low precipitation visible and a high-contrast colormap
                 levels = [0.2, 0.5, 1, 2, 5, 10, 20, 30, 40, 50, 75, 100]
-                
-                # Add cyclic point to avoid white line at Greenwich
-                tp = ds['tp']
-                data = tp.values
-                
-                # Convert units if necessary
-                if model == 'ecmwf':
-                    # ECMWF tp is in meters, convert to mm (kg/m^2)
-                    data = data * 1000.0
-                
-                lons = tp.longitude.values
-                lats = tp.latitude.values
-                data_c, lons_c = add_cyclic_point(data, coord=lons)
-                
-                im = ax.contourf(
-                    lons_c, lats, data_c,
-                    transform=ccrs.PlateCarree(), 
-                    cmap='jet', 
-                    levels=levels, 
-                    extend='max'
+
+                # Discrete band display doesn't need true iso-contours:
+                # binning each cell with digitize and looking the band color
+                # up in a precomputed LUT gives the same picture in one
+                # vectorized pass instead of contour tracing per level
+                lut = (plt.get_cmap('jet')(np.linspace(0, 1, len(levels) + 1)) * 255).astype(np.uint8)
+                lut[0, 3] = 0  # below the first band stays transparent
+                rgba = lut[np.digitize(payload['data'][lat_sl, lon_sl], levels)]
+
+                origin = 'upper' if sub_lats[0] > sub_lats[-1] else 'lower'
+                ax.imshow(
+                    rgba,
+                    extent=[sub_lons[0], sub_lons[-1], sub_lats.min(), sub_lats.max()],
+                    transform=ccrs.PlateCarree(), origin=origin
                 )
-                plt.colorbar(im, ax=ax, label='Precipitation (kg/m^2)')
-                plt.title("Total Precipitation (kg/m^2)")
+
+                # RGBA images carry no norm, so build the colorbar from the
+                # same LUT the map was binned with. Pairing BoundaryNorm
+                # with the full 256-color 'jet' would index the cmap at the
+                # raw band indices 0-10 and come out near-uniform dark blue
+                band_cmap = ListedColormap(lut[1:len(levels)] / 255.0)
+                band_cmap.set_over(lut[-1] / 255.0)
+                sm = plt.cm.ScalarMappable(
+                    norm=BoundaryNorm(levels, ncolors=len(levels) - 1), cmap=band_cmap)
+                cbar = fig.colorbar(sm, ax=ax, label='Precipitation (kg/m^2)', extend='max')
+                ax.set_title("Total Precipitation (kg/m^2)")
             elif parameter == "synoptic":
-                # 500 hPa Geopotential Height
-                ds_hgt = xr.open_dataset(grib_path, engine='cfgrib', backend_kwargs={'filter_by_keys': {'typeOfLevel': 'isobaricInhPa', 'level': 500, 'shortName': 'gh'}})
-                hgt = ds_hgt['gh']
-                
-                # 500 hPa Temperature
-                ds_tmp = xr.open_dataset(grib_path, engine='cfgrib', backend_kwargs={'filter_by_keys': {'typeOfLevel': 'isobaricInhPa', 'level': 500, 'shortName': 't'}})
-                tmp = ds_tmp['t'] - 273.15 # Convert to Celsius
-                
-                # MSLP
-                if model == 'ecmwf':
-                    ds_prmsl = xr.open_dataset(grib_path, engine='cfgrib', backend_kwargs={'filter_by_keys': {'typeOfLevel': 'meanSea', 'shortName': 'msl'}})
-                    prmsl = ds_prmsl['msl'] / 100.0 # Convert to hPa
-                else:
-                    ds_prmsl = xr.open_dataset(grib_path, engine='cfgrib', backend_kwargs={'filter_by_keys': {'typeOfLevel': 'meanSea', 'shortName': 'prmsl'}})
-                    prmsl = ds_prmsl['prmsl'] / 100.0 # Convert to hPa
-                
-                # Prepare data for plotting (cyclic point)
-                lons = hgt.longitude.values
-                lats = hgt.latitude.values
-                
-                hgt_c, lons_c = add_cyclic_point(hgt.values, coord=lons)
-                tmp_c, _ = add_cyclic_point(tmp.values, coord=lons)
-                prmsl_c, _ = add_cyclic_point(prmsl.values, coord=lons)
-                
+                hgt_c = payload['hgt'][lat_sl, lon_sl]
+                tmp_c = payload['tmp'][lat_sl, lon_sl]
+                prmsl_c = payload['prmsl'][lat_sl, lon_sl]
+                lons_c = sub_lons
+
                 # Plot Geopotential Height (Color fill)
                 # Levels similar to the image (476 to 600 gpdm -> 4760 to 6000 gpm)
-                hgt_c_gpdm = hgt_c / 10.0
-                levels_hgt = np.arange(480, 600, 4) # 4 gpdm interval
-                
-                im = ax.contourf(lons_c, lats, hgt_c_gpdm, transform=ccrs.PlateCarree(), cmap='jet', levels=levels_hgt, extend='both')
-                plt.colorbar(im, ax=ax, label='500 hPa Geopotential Height (gpdm)')
-                
+                # gpm -> gpdm in place on a contiguous copy of the crop
+                hgt_c_gpdm = np.ascontiguousarray(hgt_c)
+                np.multiply(hgt_c_gpdm, np.float32(0.1), out=hgt_c_gpdm)
+                levels_hgt = np.arange(480, 600, 4, dtype=np.float32) # 4 gpdm interval
+
+                # Project the coordinate mesh once and share it across all
+                # four plot calls below; passing lon/lat with a transform
+                # makes each contourf/contour re-project the same grid
+                # through pyproj
+                mesh_x, mesh_y = np.meshgrid(lons_c, sub_lats)
+                pts = projection.transform_points(ccrs.PlateCarree(), mesh_x, mesh_y)
+                px, py = pts[..., 0], pts[..., 1]
+
+                ax.contourf(px, py, hgt_c_gpdm, transform=projection, cmap='jet', levels=levels_hgt, extend='both')
+
+                # Same ScalarMappable trick as the other branches: skip
+                # colorbar's resampling of the 30-level QuadContourSet and
+                # draw the bands straight from the known boundaries
+                sm = plt.cm.ScalarMappable(
+                    norm=BoundaryNorm(levels_hgt, ncolors=plt.get_cmap('jet').N, extend='both'),
+                    cmap='jet')
+                cbar = fig.colorbar(sm, ax=ax, label='500 hPa Geopotential Height (gpdm)')
+
                 # Highlight 552 gpdm line
-                cs_552 = ax.contour(lons_c, lats, hgt_c_gpdm, transform=ccrs.PlateCarree(), colors='black', levels=[552], linewidths=2)
+                cs_552 = ax.contour(px, py, hgt_c_gpdm, transform=projection, colors='black', levels=[552], linewidths=2)
                 ax.clabel(cs_552, inline=True, fmt='%d', fontsize=10)
-                
+
                 # Plot MSLP (White contours)
-                levels_prmsl = np.arange(900, 1100, 5) # 5 hPa interval
-                cs_prmsl = ax.contour(lons_c, lats, prmsl_c, transform=ccrs.PlateCarree(), colors='white', levels=levels_prmsl, linewidths=1.5)
+                levels_prmsl = np.arange(900, 1100, 5, dtype=np.float32) # 5 hPa interval
+                cs_prmsl = ax.contour(px, py, prmsl_c, transform=projection, colors='white', levels=levels_prmsl, linewidths=1.5)
                 ax.clabel(cs_prmsl, inline=True, fmt='%d', fontsize=10)
-                
+
                 # Plot 500 hPa Temperature (Dashed contours)
-                levels_tmp = np.arange(-50, 20, 5) # 5 deg C interval
-                cs_tmp = ax.contour(lons_c, lats, tmp_c, transform=ccrs.PlateCarree(), colors='grey', levels=levels_tmp, linestyles='dashed', linewidths=1)
+                levels_tmp = np.arange(-50, 20, 5, dtype=np.float32) # 5 deg C interval
+                cs_tmp = ax.contour(px, py, tmp_c, transform=projection, colors='grey', levels=levels_tmp, linestyles='dashed', linewidths=1)
                 ax.clabel(cs_tmp, inline=True, fmt='%d', fontsize=8)
-                
-                plt.title("500 hPa Geopot. (gpdm), T (C), MSLP (hPa)")
-
-            plt.savefig(output_path, dpi=300, bbox_inches='tight', pad_inches=0.1)
-            plt.close()
-            
-            print(f"Map saved to {output_path}")
-            return output_path
-            
+
+                ax.set_title("500 hPa Geopot. (gpdm), T (C), MSLP (hPa)")
+
+            # No bbox_inches='tight' -- it forces a full extra render
+            # pass. compress_level=1 cuts the single-threaded zlib encode
+            # to a fraction of the default level-6 cost for a marginally
+            # larger file.
+            fig.savefig(out, format='png', dpi=100, pad_inches=0,
+                        pil_kwargs={'compress_level': 1})
+
+            # Keep the figure alive for the next render, but drop the
+            # colorbar axes so they don't pile up on the reused figure,
+            # and hand the map axes back the space the colorbar took
+            cbar.remove()
+            ax.set_position(ax_position)
+
+            print(f"Rendered {parameter} map")
+            return out
+
         except Exception as e:
-            print(f"Error generating map: {e}")
-            # Fallback for testing if GRIB reading fails (e.g. if file is dummy or incomplete)
-            self._create_dummy_image(output_path, f"Error: {e}")
-            return output_path
-
-    def _create_dummy_image(self, output_path, text):
-        print("Creating dummy image due to error...")
-        fig, ax = plt.subplots()
-        ax.text(0.5, 0.5, text, ha='center', va='center', wrap=True)
-        ax.set_xlim(0, 1)
-        ax.set_ylim(0, 1)
-        plt.savefig(output_path)
-        plt.close()
+            print(f"Error rendering map: {e}")
+            # The cached figure may be half-drawn at this point; rebuild it
+            self._reset_figure()
+            # Propagate instead of writing a placeholder image: with
+            # skip-if-exists on, an error PNG uploaded under the real
+            # object name would poison that map forever -- every
+            # redelivery sees the key exists and skips the re-render.
+            raise
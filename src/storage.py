@@ -1,6 +1,10 @@
 from minio import Minio
+from minio.error import S3Error
+import urllib3
 import config
+import io
 import os
+import time
 
 class Storage:
     def __init__(self):
@@ -10,7 +14,22 @@ class Storage:
             endpoint,
             access_key=config.MINIO_ACCESS_KEY,
             secret_key=config.MINIO_SECRET_KEY,
-            secure=False # Assuming internal http for now
+            secure=False, # Assuming internal http for now
+            # Enough pooled keep-alive connections for parallel part
+            # uploads and concurrent upload threads. Passing a custom
+            # PoolManager replaces minio-py's default client wholesale,
+            # so restate its timeout and retry policy -- otherwise a hung
+            # connection blocks an upload thread (or a worker's
+            # skip-if-exists HEAD) forever, with no retries.
+            http_client=urllib3.PoolManager(
+                maxsize=32,
+                timeout=urllib3.util.Timeout(connect=300, read=300),
+                retries=urllib3.Retry(
+                    total=5,
+                    backoff_factor=0.2,
+                    status_forcelist=[500, 502, 503, 504]
+                )
+            )
         )
         self._ensure_bucket()
 
@@ -32,6 +51,42 @@ class Storage:
             print(f"Error uploading file: {e}")
             return False
 
+    def object_exists(self, object_name):
+        # A ~10ms HEAD beats a multi-second re-render on replays
+        try:
+            self.client.stat_object(config.MINIO_BUCKET, object_name)
+            return True
+        except S3Error as e:
+            if e.code != 'NoSuchKey':
+                print(f"Error checking {object_name}: {e}")
+            return False
+
+    def upload_bytes(self, data, object_name):
+        # Upload straight from memory; saves the /tmp write + re-read that
+        # upload_file pays for data that only needs to cross the network once
+        try:
+            if isinstance(data, (bytes, bytearray)):
+                data = io.BytesIO(data)
+            length = data.getbuffer().nbytes
+            data.seek(0)
+            start = time.time()
+            self.client.put_object(
+                config.MINIO_BUCKET,
+                object_name,
+                data,
+                length,
+                content_type="image/png",
+                # Split big PNGs into 8 MB parts uploaded in parallel
+                part_size=8 * 1024 * 1024,
+                num_parallel_uploads=8
+            )
+            print(f"Uploaded {object_name} to {config.MINIO_BUCKET} "
+                  f"({length / 1024:.0f} KB in {time.time() - start:.2f}s)")
+            return True
+        except Exception as e:
+            print(f"Error uploading bytes: {e}")
+            return False
+
     def delete_file(self, object_name):
         try:
             self.client.remove_object(config.MINIO_BUCKET, object_name)